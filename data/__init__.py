@@ -1,2 +1,3 @@
 from .anime_data import *
-from .trans import PadResize, ShortResize
\ No newline at end of file
+from .trans import PadResize, ShortResize, BlendWaterMark
+from .prefetcher import CUDAPrefetcher
@@ -7,6 +7,7 @@ from pathlib import Path
 from PIL import Image
 import numpy as np
 import json
+from .trans import BlendWaterMark
 
 # from PIL import ImageFile
 # ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -19,9 +20,17 @@ class WaterMarkDataset(data.Dataset):
         root=Path(root)
         self.data_list=[str(x) for x in root.iterdir()]
 
-        self.water_mark = water_mark.copy()
-        self.water_mark_mask = water_mark_mask.copy()
-        self.w_mark, self.h_mark = self.water_mark.size
+        if isinstance(water_mark, torch.Tensor):
+            # pre-resized watermark, blended in tensor space after transform, no mask is returned.
+            # transform must produce uint8 or [0,1] tensors with the same H, W as water_mark
+            if transform is None:
+                raise ValueError('a tensor water_mark needs a transform that outputs tensors of its size')
+            self.blend = BlendWaterMark(water_mark, alpha_r=(0.95, 1.05), noise_std=noise_std)
+        else:
+            self.blend = None
+            self.water_mark = water_mark.copy()
+            self.water_mark_mask = water_mark_mask.copy()
+            self.w_mark, self.h_mark = self.water_mark.size
 
     def make_water_mark(self, img, size_r=(0.9, 1.0), alpha_r=(0.95, 1.05), offset_r=(10, 10)):
         w, h = img.size
@@ -58,6 +67,10 @@ class WaterMarkDataset(data.Dataset):
         return img, img_mask
 
     def __getitem__(self, idx):
+        if self.blend is not None:
+            img_clean = self.transform(Image.open(self.data_list[idx]).convert('RGB'))
+            return self.blend(img_clean), img_clean
+
         img = Image.open(self.data_list[idx]).convert('RGBA')
         img_clean = img.convert('RGB')
 
@@ -166,9 +179,13 @@ class PairDatasetMark(data.Dataset):
         root_mark = Path(root_mark)
         self.data_list_mark=[str(x) for x in root_mark.iterdir()]
 
-        self.water_mark = water_mark.copy()
-        self.water_mark_mask = water_mark_mask.copy()
-        self.w_mark, self.h_mark = self.water_mark.size
+        if water_mark is None:
+            # no watermark, the caller blends it into img_clean (e.g. on the GPU)
+            self.water_mark = None
+        else:
+            self.water_mark = water_mark.copy()
+            self.water_mark_mask = water_mark_mask.copy()
+            self.w_mark, self.h_mark = self.water_mark.size
 
     def make_water_mark(self, img):
         w, h = img.size
@@ -197,6 +214,12 @@ class PairDatasetMark(data.Dataset):
         img_mark = Image.open(self.data_list_mark[idx]).convert('RGB')
         img_clean = Image.open(random.choice(self.data_list_clean)).convert('RGB')
 
+        if self.water_mark is None:
+            if self.transform is not None:
+                img_mark = self.transform(img_mark)
+                img_clean = self.transform(img_clean)
+            return img_mark, img_clean
+
         fake_mark, mark_mask = self.make_water_mark(img_clean.copy())
 
         if self.transform is not None:
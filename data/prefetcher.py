@@ -0,0 +1,43 @@
+import torch
+
+class CUDAPrefetcher:
+    """
+    Copy the next batch to the GPU on a side stream while the current one is being computed.
+    The loader must use pin_memory=True for the copies to be asynchronous.
+    """
+    def __init__(self, loader, device, transform=None):
+        self.loader = loader
+        self.device = device
+        self.transform = transform
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            batch = tuple(x.to(self.device, non_blocking=True) for x in batch)
+            if self.transform is not None:
+                batch = self.transform(batch)
+            self.next_batch = batch
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        for x in batch:
+            x.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
@@ -1,6 +1,7 @@
 from torchvision.transforms.functional import InterpolationMode
 from torchvision.transforms import functional as F
 from PIL import Image
+import torch
 
 class PadResize:
     def __init__(self, w, interpolation=InterpolationMode.BILINEAR, make_pad=True):
@@ -31,4 +32,38 @@ class ShortResize:
             else:
                 ws = int((w/h)*self.edge)
                 img = F.resize(img, [self.edge, ws], self.interpolation)
-        return img
\ No newline at end of file
+        return img
+
+class BlendWaterMark:
+    def __init__(self, water_mark, alpha_r=(0.9, 1.1), gamma_r=(0.76, 1.3), noise_std=0.):
+        # water_mark: RGBA tensor in [0,1], already resized to the size of the images it is blended into
+        self.water_mark = water_mark
+        self.alpha_r = alpha_r
+        self.gamma_r = gamma_r
+        self.noise_std = noise_std
+
+        rows = (water_mark[3] > 0).any(dim=1).nonzero()
+        self.t, self.b = rows.min().item(), rows.max().item()+1
+
+    def to(self, device):
+        self.water_mark = self.water_mark.to(device)
+        return self
+
+    def __call__(self, img:torch.Tensor):
+        is_uint8 = img.dtype == torch.uint8
+        if is_uint8:
+            img = img/255.
+
+        shape = img.shape[:-3]+(1, 1, 1)
+        rand = lambda r: torch.empty(shape, device=img.device).uniform_(*r)
+
+        alpha = (self.water_mark[3:]*rand(self.alpha_r)).clip(0, 1)
+        water_mark = self.water_mark[:3]**rand(self.gamma_r)
+        img = alpha*water_mark+(1.-alpha)*img
+        if self.noise_std>0:
+            img[..., self.t:self.b, :] += torch.randn_like(img[..., self.t:self.b, :])*rand((0, self.noise_std))
+        img = img.clip(0, 1)
+
+        if is_uint8:
+            img = (img*255.).round().to(torch.uint8)
+        return img
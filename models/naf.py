@@ -2,11 +2,16 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from .layers import LayerNorm2d
 
 def checkpoint(function):
     def wrapper(*args, **kwargs):
-        kwargs.setdefault("use_reentrant", True)
+        # nothing to recompute when no graph is built (eval/test)
+        if not torch.is_grad_enabled():
+            return function(*args, **kwargs)
+        # non-reentrant works with frozen inputs, DDP and torch.compile
+        kwargs.setdefault("use_reentrant", False)
         return torch.utils.checkpoint.checkpoint(function, *args, **kwargs)
 
     if os.environ.get("GRAD_CKPT", "1") == "1":
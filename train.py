@@ -170,8 +170,6 @@ class Trainer:
     @torch.no_grad()
     def evaluate(self):
         self.net.eval()
-        mean = torch.tensor([0.5]).to(self.accelerator.device)
-        std = torch.tensor([0.5]).to(self.accelerator.device)
         psnr = 0
         for step, (img_mark, img_clean) in enumerate(self.test_loader):
             img_clean = img_clean.to(self.accelerator.device)
@@ -179,7 +177,7 @@ class Trainer:
 
             pred = self.net(img_mark)
 
-            psnr += cal_psnr(pred, img_clean, mean, std).sum().item()
+            psnr += cal_psnr(pred, img_clean).sum().item()
 
         psnr = torch.tensor(psnr).to(self.accelerator.device)
         psnr = self.accelerator.reduce(psnr, reduction="sum")
@@ -2,8 +2,10 @@ import os
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 from torchvision import transforms
 from data.anime_data import WaterMarkDataset, PairDatasetMark
+from data import CUDAPrefetcher, PadResize, BlendWaterMark
 from argparse import ArgumentParser
 from loguru import logger
 import datetime
@@ -11,7 +13,7 @@ from models import NAFNet, Discriminator
 from PIL import Image
 
 from accelerate import Accelerator
-from accelerate.utils import set_seed
+from accelerate.utils import set_seed, DistributedDataParallelKwargs, DDPCommunicationHookType
 from utils import cal_psnr
 
 class Trainer:
@@ -20,11 +22,21 @@ class Trainer:
         self.alpha = args.alpha
 
         set_seed(42)
+        torch.set_float32_matmul_precision('high')
 
+        ddp_kwargs = DistributedDataParallelKwargs(
+            find_unused_parameters=False,
+            gradient_as_bucket_view=True,
+            # all-reduce gradients in bf16 to halve the communication volume
+            comm_hook=DDPCommunicationHookType.BF16 if args.mixed_precision == 'bf16' else DDPCommunicationHookType.NO,
+        )
         self.accelerator = Accelerator(
+            mixed_precision=args.mixed_precision,
             gradient_accumulation_steps=1,
             step_scheduler_with_optimizer=False,
+            kwargs_handlers=[ddp_kwargs],
         )
+        self.use_cuda = self.accelerator.device.type == 'cuda'
 
         self.build_data()
         self.build_model()
@@ -39,20 +51,30 @@ class Trainer:
         else:
             logger.disable("__main__")
 
-        self.net_G, self.net_D, self.optimizer, train_loader, val_loader = \
-            self.accelerator.prepare(self.net_G, self.net_D, self.optimizer, self.train_loader, self.test_loader)
+        self.net_G, self.net_D, self.optimizer, self.optimizer_D, train_loader, val_loader = \
+            self.accelerator.prepare(self.net_G, self.net_D, self.optimizer, self.optimizer_D, self.train_loader, self.test_loader)
 
     def build_model(self):
         self.net_G = NAFNet(width=24, enc_blk_nums=[1,2,4,6], middle_blk_num=8, dec_blk_nums=[2,2,1,1])
         self.net_D = Discriminator((3,800,800))
+        self.d_output_shape = self.net_D.output_shape
+        # on the device before building the fused optimizers
+        self.net_G = self.net_G.to(self.accelerator.device, memory_format=torch.channels_last)
+        self.net_D = self.net_D.to(self.accelerator.device, memory_format=torch.channels_last)
+
+        if self.args.compile:
+            import torch._inductor.config
+            torch._inductor.config.conv_1x1_as_mm = True
+            torch._inductor.config.coordinate_descent_tuning = True
+            # no fullgraph: NAFBlock's LayerNorm2d is the custom autograd LayerNormFunction, whose
+            # backward reads ctx.saved_variables, which dynamo cannot trace and breaks the graph on
+            self.net_G = torch.compile(self.net_G, mode='max-autotune')
+            self.net_D = torch.compile(self.net_D, mode='max-autotune')
 
         #summary(self.net_G, (3, 224, 224))
 
-        self.optimizer = torch.optim.AdamW(self.net_G.parameters(), lr=self.args.lr)
-        self.optimizer_D = torch.optim.AdamW(self.net_D.parameters(), lr=self.args.lr)
-        self.criterion = nn.SmoothL1Loss()
-        self.criterion_gan = nn.MSELoss()
-        self.criterion_mask = nn.SmoothL1Loss(reduction='none')
+        self.optimizer = torch.optim.AdamW(self.net_G.parameters(), lr=self.args.lr, fused=self.use_cuda)
+        self.optimizer_D = torch.optim.AdamW(self.net_D.parameters(), lr=self.args.lr, fused=self.use_cuda)
         print(len(self.train_loader))
 
         # self.scheduler = lr_scheduler.OneCycleLR(self.optimizer, max_lr=self.args.lr,
@@ -63,102 +85,162 @@ class Trainer:
         #                                     pct_start=0.2)
 
     def build_data(self):
-        water_mark = Image.open(self.args.water_mark)
-        water_mark_mask = Image.open(self.args.water_mark_mask).convert('RGB')
+        # resize the watermark to the training resolution once, it is only blended afterwards
+        mark_trans = transforms.Compose([
+            PadResize(800),
+            transforms.CenterCrop(800),
+            transforms.ToTensor(),
+        ])
+        water_mark = mark_trans(Image.open(self.args.water_mark).convert('RGBA'))
+        # fake_mark of the training set is blended on the GPU, see preprocess_train
+        self.blend = BlendWaterMark(water_mark, alpha_r=(0.9, 1.1), noise_std=0.1).to(self.accelerator.device)
         self.data_train = PairDatasetMark(root_clean=self.args.train_root_clean, root_mark=self.args.train_root_mark,
-                                          water_mark=water_mark, water_mark_mask=water_mark_mask,
+                                          water_mark=None, water_mark_mask=None,
                                           transform=transforms.Compose([
                                                 transforms.Resize(800),
                                                 transforms.CenterCrop(800),
-                                                transforms.ToTensor(),
-                                                transforms.Normalize([0.5], [0.5]),
+                                                transforms.PILToTensor(),
                                            ]),)
-        self.data_test = WaterMarkDataset(root=self.args.test_root, water_mark=water_mark, water_mark_mask=water_mark_mask,
+        self.data_test = WaterMarkDataset(root=self.args.test_root, water_mark=water_mark, water_mark_mask=None,
                                           noise_std=0,
                                           transform=transforms.Compose([
                                               transforms.Resize(800),
                                               transforms.CenterCrop(800),
-                                              transforms.ToTensor(),
-                                              transforms.Normalize([0.5], [0.5]),
+                                              transforms.PILToTensor(),
                                           ]),)
+        # workers send uint8 batches, dtype conversion and normalization run on the GPU
+        self.gpu_transform = nn.Sequential(
+            transforms.ConvertImageDtype(torch.float),
+            transforms.Normalize([0.5], [0.5]),
+        )
 
+        train_kwargs = dict(num_workers=self.args.num_workers, pin_memory=True)
+        if self.args.num_workers > 0:
+            train_kwargs.update(persistent_workers=True, prefetch_factor=4)
+        # drop_last keeps the training batch shape static for torch.compile
         self.train_loader = torch.utils.data.DataLoader(self.data_train, batch_size=self.args.bs, shuffle=True,
-                                                        num_workers=self.args.num_workers, pin_memory=True)
+                                                        drop_last=True, **train_kwargs)
+        # the test set is read once per epoch, its workers are not kept alive in between
         self.test_loader = torch.utils.data.DataLoader(self.data_test, batch_size=self.args.bs, shuffle=False,
                                                         num_workers=self.args.num_workers, pin_memory=True)
 
+    def preprocess(self, batch):
+        return tuple(self.gpu_transform(x.contiguous(memory_format=torch.channels_last)) for x in batch)
+
+    def preprocess_train(self, batch):
+        img, img_clean = batch
+        return self.preprocess((img, img_clean, self.blend(img_clean)))
+
+    def iter_train(self):
+        # fallback of CUDAPrefetcher for non-CUDA devices
+        for batch in self.train_loader:
+            yield self.preprocess_train(tuple(x.to(self.accelerator.device) for x in batch))
+
     def train(self):
-        valid = torch.tensor(1.).to(self.accelerator.device)
-        fake = torch.tensor(0.).to(self.accelerator.device)
+        # targets with the discriminator's output shape, so MSE does not broadcast every step
+        valid = torch.ones((self.args.bs, *self.d_output_shape), device=self.accelerator.device)
+        fake = torch.zeros((self.args.bs, *self.d_output_shape), device=self.accelerator.device)
 
-        loss_sum_G, loss_sum_D = 0, 0
-        for ep in range(self.args.epochs):
-            for step, (img, img_clean, fake_mark) in enumerate(self.train_loader):
-                img = img.to(self.accelerator.device)
-                img_clean = img_clean.to(self.accelerator.device)
-                fake_mark = fake_mark.to(self.accelerator.device)
+        if self.use_cuda:
+            train_prefetcher = CUDAPrefetcher(self.train_loader, self.accelerator.device, transform=self.preprocess_train)
 
+        loss_sum_G = torch.zeros((), device=self.accelerator.device)
+        loss_sum_D = torch.zeros((), device=self.accelerator.device)
+        for ep in range(self.args.epochs):
+            for step, (img, img_clean, fake_mark) in enumerate(train_prefetcher if self.use_cuda else self.iter_train()):
                 #  Train Generators
                 self.net_G.train()
                 self.net_G.requires_grad_(True)
                 self.net_D.eval()
                 self.net_D.requires_grad_(False)
-                self.optimizer.zero_grad()
+                self.optimizer.zero_grad(set_to_none=True)
 
-                fake_A = self.net_G(img)
-                fake_B = self.net_G(fake_mark)
-                pred_fake_A = self.net_D(fake_A)
-                loss = self.criterion_gan(pred_fake_A, valid) + self.alpha*self.criterion(img_clean, fake_B)
+                # NAFNet only uses per-sample LayerNorm2d, so both inputs can share one forward
+                fake_A, fake_B = self.net_G(torch.cat([img, fake_mark], dim=0)).chunk(2, dim=0)
+                # net_D is frozen here, keep its DDP reducer out of the generator backward
+                with self.accelerator.no_sync(self.net_D):
+                    pred_fake_A = self.net_D(fake_A)
+                loss = (pred_fake_A-valid).pow(2).mean() + self.alpha*F.smooth_l1_loss(fake_B, img_clean)
 
                 self.accelerator.backward(loss)
                 self.optimizer.step()
                 #self.scheduler.step()
 
-                loss_sum_G += loss.item()
+                loss_sum_G += loss.detach()
 
                 #  Train Discriminator
                 self.net_G.eval()
                 self.net_G.requires_grad_(False)
                 self.net_D.train()
                 self.net_D.requires_grad_(True)
-                self.optimizer_D.zero_grad()
+                self.optimizer_D.zero_grad(set_to_none=True)
 
-                pred_real = self.net_D(img_clean)
-                pred_img_fake = self.net_D(img)
-                pred_fake = self.net_D(fake_A.detach())
+                # one batched forward, InstanceNorm keeps the samples independent.
+                # img_clean/img must be run here and not reused from the generator step:
+                # net_D is frozen there, so its outputs carry no gradient for net_D's parameters.
+                pred_all = self.net_D(torch.cat([img_clean, img, fake_A.detach()], dim=0))
+                pred_real, pred_img_fake, pred_fake = pred_all.chunk(3, dim=0)
 
-                loss = (self.criterion_gan(pred_real, valid) + self.criterion_gan(pred_fake, fake) + self.criterion_gan(pred_img_fake, fake))/2
+                loss = ((pred_real-valid).pow(2).mean() + (pred_fake-fake).pow(2).mean() + (pred_img_fake-fake).pow(2).mean())/2
 
                 self.accelerator.backward(loss)
                 self.optimizer_D.step()
                 #self.scheduler_D.step()
 
-                loss_sum_D += loss.item()
+                loss_sum_D += loss.detach()
 
                 if step % self.args.log_step == 0:
                     logger.info(f'[{ep+1}/{self.args.epochs}]<{step+1}/{len(self.train_loader)}>, '
-                                f'loss_G:{loss_sum_G / self.args.log_step:.3e}, '
-                                f'loss_D:{loss_sum_D / self.args.log_step:.3e}, '
-                                f'lr:{self.optimizer.state_dict()["param_groups"][0]["lr"]:.3e}')
-                    loss_sum_G = 0
-                    loss_sum_D = 0
+                                f'loss_G:{loss_sum_G.item() / self.args.log_step:.3e}, '
+                                f'loss_D:{loss_sum_D.item() / self.args.log_step:.3e}, '
+                                f'lr:{self.optimizer.param_groups[0]["lr"]:.3e}')
+                    loss_sum_G.zero_()
+                    loss_sum_D.zero_()
             self.test()
             if self.accelerator.is_local_main_process:
-                torch.save(self.net_G.state_dict(), f'output_GAN/ep_{ep}.pth')
-
-    @torch.no_grad()
+                net_G = self.accelerator.unwrap_model(self.net_G)
+                torch.save(getattr(net_G, '_orig_mod', net_G).state_dict(), f'output_GAN/ep_{ep}.pth')
+
+    def build_test_graph(self):
+        # capture net_G for the fixed test shape. The graph's private memory pool holds the activations
+        # of one bs x 800 x 800 inference forward, so test() drops the graph before training resumes.
+        net_G = self.accelerator.unwrap_model(self.net_G)
+        static_img = torch.zeros((self.args.bs, 3, 800, 800), device=self.accelerator.device)
+        static_img = static_img.contiguous(memory_format=torch.channels_last)
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(2):
+                net_G(static_img)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_pred = net_G(static_img)
+        return graph, static_img, static_pred
+
+    @torch.inference_mode()
     def test(self):
         self.net_G.eval()
-        mean = torch.tensor([0.5]).to(self.accelerator.device)
-        std = torch.tensor([0.5]).to(self.accelerator.device)
+        # compiled max-autotune models already run as CUDA graphs.
+        # Capture before the loader is iterated, its pin_memory thread must not make CUDA calls during capture.
+        test_graph = self.build_test_graph() if self.use_cuda and not self.args.compile else None
+
         psnr=0
-        for step, (img, img_clean, img_mask) in enumerate(self.test_loader):
-            img = img.to(self.accelerator.device)
-            img_clean = img_clean.to(self.accelerator.device)
+        for step, (img, img_clean) in enumerate(self.test_loader):
+            img, img_clean = self.preprocess((img.to(self.accelerator.device, non_blocking=True),
+                                              img_clean.to(self.accelerator.device, non_blocking=True)))
 
-            pred = self.net_G(img)
+            # the last batch may be smaller than the captured shape
+            if test_graph is None or img.shape[0] != self.args.bs:
+                pred = self.net_G(img)
+            else:
+                graph, static_img, pred = test_graph
+                static_img.copy_(img)
+                graph.replay()
 
-            psnr+=cal_psnr(pred, img_clean, mean, std).sum().item()
+            psnr+=cal_psnr(pred, img_clean).sum().item()
 
         psnr = torch.tensor(psnr).to(self.accelerator.device)
         psnr = self.accelerator.reduce(psnr, reduction="sum")
@@ -171,13 +253,15 @@ def make_args():
     parser.add_argument("--train_root_mark", default='../datas/imgs_water_mark', type=str)
     parser.add_argument("--test_root", default='../datas/anime_SR/test/HR', type=str)
     parser.add_argument("--water_mark", default='./water_mark2.png', type=str)
-    parser.add_argument("--water_mark_mask", default='./water_mark2_mask.png', type=str)
     parser.add_argument("--bs", default=4, type=int)
     parser.add_argument("--lr", default=1e-3, type=float)
     parser.add_argument("--epochs", default=100, type=int)
-    parser.add_argument("--num_workers", default=8, type=int)
+    # per process, the cores are shared by all processes of this node
+    parser.add_argument("--num_workers", default=max(1, min(16, os.cpu_count() or 1)//int(os.environ.get("LOCAL_WORLD_SIZE", 1))), type=int)
     parser.add_argument("--log_dir", default='logs/', type=str)
     parser.add_argument("--log_step", default=20, type=int)
+    parser.add_argument("--mixed_precision", default='bf16', type=str, choices=['no', 'fp16', 'bf16'])
+    parser.add_argument("--compile", action='store_true')
 
     parser.add_argument("--alpha", default=0.1, type=float)
     args = parser.parse_args()